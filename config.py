@@ -5,3 +5,15 @@ BuildingCentroids = "data/ORNL_USAStructures_Centroids_LightboxSpatialJoin.gdb"
 # For testing mode, update the file paths for the Napa and Idaho directories
 NapaEventDir = "data/testing/napa2014shakemap_fortesting"
 IdahoEventDir = "data/testing/idaho2017shakemap_fortesting"
+
+# Retention policy for archived ShakeMap versions and event folders (see utils/workspace_manager.py)
+ArchiveMaxAgeDays = 90
+ArchiveMaxBytes = 20 * 1024 ** 3
+
+# Chunked mode processes tracts in batches that fit in ChunkMemoryLimitMB, and counts building centroids
+# in partitions sized from it, for very large events or scenarios that do not fit in memory
+ChunkedMode = False
+ChunkMemoryLimitMB = 1024
+
+# Number of worker processes used to count building centroids per state (None = one per core)
+BuildingWorkers = None
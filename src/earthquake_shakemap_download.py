@@ -3,12 +3,15 @@ from urllib.request import urlopen
 import geopandas as gpd
 import json
 import os
+import shutil
 import zipfile
 import io
 import datetime
 from utils.within_conus import check_coords
 from utils.get_file_paths import get_shakemap_dir
-from utils.status_logger import log_status, get_last_status
+from utils import event_registry
+from utils.workspace_manager import archive_event_version, apply_retention, mark_seen, record_current_version
+import config
 
 FEEDURL = 'https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/significant_week.geojson' #Significant Events - 1 week
 #FEEDURL = 'https://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/4.5_hour.geojson' #1 hour M4.5+
@@ -64,13 +67,11 @@ def create_shakemap_gis_files(shapezip_url: str, event_dir: str, earthquake_dict
     time_pretty = datetime.datetime.fromtimestamp(int(time[:-3])).strftime('%c')
     place = str(earthquake_dict['properties']['place'])
     url = str(earthquake_dict['properties']['url'])
-    event_id = str(event_id)
+    event_id = str(earthquake_dict['id'])
     status = str(earthquake_dict['properties']['status'])
     updated = str(earthquake_dict['properties']['updated'])
     updated_pretty = datetime.datetime.fromtimestamp(int(updated[:-3])).strftime('%c')
 
-    log_status(event_dir, status, updated)
-
     event_details = (title, mag, time_pretty, place, depth, url, event_id)
     print('New event successfully downloaded: \n', event_details)
 
@@ -92,12 +93,13 @@ def create_shakemap_gis_files(shapezip_url: str, event_dir: str, earthquake_dict
     event_gdf.to_file(os.path.join(event_dir, "epicenter.shp"))
 
 
-def check_for_shakemaps(mmi_threshold: int = 4) -> list:
+def check_for_shakemaps(mmi_threshold: int = 4, conn=None) -> list:
     """
     Check for shakemaps using the uncommented FEEDURL.
 
     Args:
         mmi_threshold (int): MMI threshold for earthquakes to download.
+        conn (sqlite3.Connection): event registry connection, opens the default registry if None
     
     Returns:
         new_shakemap_folders (list): list of file paths for the data that was extracted
@@ -105,10 +107,16 @@ def check_for_shakemaps(mmi_threshold: int = 4) -> list:
 
     shakemap_dir = get_shakemap_dir()
     new_shakemap_folders = []
+    if conn is None:
+        conn = event_registry.connect()
 
     data = get_data_from_url(FEEDURL)
     feed_dict = json.loads(data) #Parse that Data using the stdlib json module.  This turns into a Python dictionary.
 
+    # events still in the feed are not evicted by the retention policy
+    feed_event_ids = {earthquake_dict['id'] for earthquake_dict in feed_dict['features']}
+    mark_seen(shakemap_dir, feed_event_ids)
+
     # noinspection PyUnboundLocalVariable
     for earthquake_dict in feed_dict['features']: #jdict['features'] is the list of events
         event_id = earthquake_dict['id']
@@ -141,15 +149,28 @@ def check_for_shakemaps(mmi_threshold: int = 4) -> list:
             os.mkdir(event_dir)
             print("New Event ID: {}".format(event_dir))
 
-            create_shakemap_gis_files(shapezip_url, event_dir, earthquake_dict)
-            
+            try:
+                create_shakemap_gis_files(shapezip_url, event_dir, earthquake_dict)
+            except Exception:
+                # remove the partial download, so the next poll downloads the event again
+                shutil.rmtree(event_dir)
+                raise
+            record_current_version(shakemap_dir, event_id, event_dir, earthquake_dict['properties']['updated'],
+                                   str(earthquake_dict['properties']['status']))
+            # queue the event only once all of its files are written
+            event_registry.record_event(conn, event_id, event_dir, str(earthquake_dict['properties']['status']),
+                                        earthquake_dict['properties']['updated'])
+
             file_list = os.listdir(event_dir)
             print('Extracted {} ShakeMap files to {}'.format(len(file_list), event_dir))
             new_shakemap_folders.append(event_dir)
 
         else:
 
-            old_status, old_updated = get_last_status(event_dir)
+            old_status, old_updated = event_registry.get_last_status(conn, event_id)
+            if old_updated is None:
+                # folder was downloaded before the event registry existed, use the folder time as its version
+                old_updated = str(int(os.path.getmtime(event_dir) * 1000))
 
             status = str(earthquake_dict['properties']['status'])
             updated = str(earthquake_dict['properties']['updated'])
@@ -166,34 +187,25 @@ def check_for_shakemaps(mmi_threshold: int = 4) -> list:
 
             if recent_update or status_change:
 
-                # create archive subdirectory
-                list_subfolders = [f.name for f in os.scandir(event_dir) if f.is_dir()]
-                old_date = datetime.datetime.fromtimestamp(int(old_updated[:-3])).strftime('%Y%m%d')
-                archive_folder_name = "archive_{}".format(old_date)
-                archive_zip_name = archive_folder_name + ".zip"
-
-                if not archive_zip_name in list_subfolders:
-                    # copy all old files to new archive folder
-                    archive_zip_path = os.path.join(event_dir, archive_zip_name)
-                    files_to_move = [f for f in os.listdir(event_dir) if os.path.isfile(os.path.join(event_dir, f))]
-                    files_to_move.remove('event_info.txt')
-
-                    with zipfile.ZipFile(archive_zip_path, 'w') as zip:
-                        for file in files_to_move:
-                            zip.write(os.path.join(event_dir, file))
-                    for file in files_to_move:
-                        os.remove(os.path.join(event_dir, file))
-
-                else:
-                    # delete all old files if they have already been moved to archive folder
-                    files_to_delete = [f for f in os.listdir(event_dir) if os.path.isfile(os.path.join(event_dir, f))]
-                    files_to_delete.remove('event_info.txt')
-                    for file in files_to_delete:
-                        os.remove(os.path.join(event_dir, file))
-
-                print("\nPreviously downloaded ShakeMap files for {} have been archived.".format(event_id))
+                if not event_registry.begin_download(conn, event_id):
+                    # the folder is in use, the update is picked up by the next poll once processing is done
+                    print("\nShakeMap files for {} have been updated but are being processed.".format(event_id))
+                    continue
 
-                create_shakemap_gis_files(shapezip_url, event_dir, earthquake_dict)
+                try:
+                    # move the old files into the compressed, deduplicated archive
+                    archive_event_version(shakemap_dir, event_id, event_dir, old_updated, old_status)
+
+                    print("\nPreviously downloaded ShakeMap files for {} have been archived.".format(event_id))
+
+                    create_shakemap_gis_files(shapezip_url, event_dir, earthquake_dict)
+                except Exception:
+                    # the event is retried by the next poll while the feed lists the newer version
+                    event_registry.abort_download(conn, event_id)
+                    raise
+                record_current_version(shakemap_dir, event_id, event_dir, updated, status)
+                # queue the event only once all of its files are written
+                event_registry.record_event(conn, event_id, event_dir, status, updated)
 
                 filecount = [f for f in os.listdir(event_dir) if os.path.isfile(os.path.join(event_dir, f))]
                 print('Successfully downloaded {} ShakeMap files to {}'.format(len(filecount), event_dir))
@@ -203,6 +215,15 @@ def check_for_shakemaps(mmi_threshold: int = 4) -> list:
 
                 print("\nShakeMap files for {} already exist and have not been updated.".format(event_id))
 
+    # prune old archives and stale event folders, except events still in the feed (they would be downloaded
+    # and processed again on the next poll) and events waiting for or being processed
+    evicted_versions, evicted_events = apply_retention(shakemap_dir,
+                                                       max_age_days=config.ArchiveMaxAgeDays,
+                                                       max_total_bytes=config.ArchiveMaxBytes,
+                                                       protected=feed_event_ids | event_registry.get_active_event_ids(conn))
+    for event_id in evicted_events:
+        event_registry.delete_event(conn, event_id)
+
     print("Completed.")
 
     return new_shakemap_folders
@@ -1,35 +1,76 @@
 import os
 import time
-        
+
 from earthquake_shakemap_download import check_for_shakemaps
 import o2_Earthquake_ShakeMap_Into_CensusGeographies
 import o3_Earthquake_GetBldgCentroids
 import o4_TractLevel_DamageAssessmentModel
+from utils import event_registry, workspace_manager
+from utils.get_file_paths import get_shakemap_dir
 import config
 
 
+def run_stage(conn, event_id, claim, stage, func, **kwargs):
+    """
+    Run a pipeline stage and record it. Every stage returns (output, results): the filepath of its output and
+    a summary of it to record (dict, or None). Returns False if the event was re-queued while the stage ran.
+    """
+    start_time = time.time()
+    output, results = func(**kwargs)
+    return event_registry.record_stage(conn, event_id, claim, stage, time.time() - start_time, output, results)
+
+
+def process_event(conn, event_id, claim, event):
+    print('\nCensus Data Processing for: ', event)
+    if not run_stage(conn, event_id, claim, "census_geographies",
+                     o2_Earthquake_ShakeMap_Into_CensusGeographies.shakemap_into_census_geo, eventdir = event):
+        return False
+
+    print('\nGathering Building Outlines for: ', event)
+    if not run_stage(conn, event_id, claim, "building_centroids",
+                     o3_Earthquake_GetBldgCentroids.shakemap_get_bldgs, eventdir = event):
+        return False
+
+    print('\nRunning Tract-Level Damage Assessment Model for: ', event)
+    return run_stage(conn, event_id, claim, "damage_assessment",
+                     o4_TractLevel_DamageAssessmentModel.main, eventdir = event)
+
+
 def main(testingmode = True):
+    conn = event_registry.connect()
+
     if not testingmode:
         # if not in testing mode, look for real new shakemaps
-        new_events = check_for_shakemaps()
-        # new events should be a list of newly downloaded earthquake event folders
+        # new and updated events are queued for processing in the event registry
+        check_for_shakemaps(conn=conn)
 
 
     else:
         # if testing mode, use the napa 2014 shakemap
         print('testing mode')
-        # new_events = [config.NapaEventDir]
-        new_events = [config.IdahoEventDir]
+        # event = config.NapaEventDir
+        event = config.IdahoEventDir
+        # use the current time as the version so the test event is always reprocessed
+        event_registry.record_event(conn, os.path.basename(event), event, "testing", int(time.time() * 1000))
 
-    for event in new_events:
-        print('\nCensus Data Processing for: ', event)
-        o2_Earthquake_ShakeMap_Into_CensusGeographies.shakemap_into_census_geo(eventdir = event)
+    # claim events one at a time, so several workers can run main() against the same registry
+    claimed = event_registry.claim_event(conn)
+    while claimed is not None:
+        event_id, claim = claimed["event_id"], claimed["claimed_by"]
+        try:
+            finished = process_event(conn, event_id, claim, claimed["event_dir"])
+        except Exception:
+            event_registry.set_pipeline_state(conn, event_id, claim, "failed")
+            raise
+        finally:
+            # the stage outputs count toward the retention size budget
+            workspace_manager.record_event_size(get_shakemap_dir(), event_id)
+        # a new ShakeMap version queued while processing stays pending and is processed again
+        if not finished or not event_registry.set_pipeline_state(conn, event_id, claim, "complete"):
+            print('\n{} was updated while processing, its results are out of date.'.format(event_id))
+        claimed = event_registry.claim_event(conn)
 
-        print('\nGathering Building Outlines for: ', event)
-        ORNL_LB_bldgs = o3_Earthquake_GetBldgCentroids.shakemap_get_bldgs(eventdir = event)
-
-        print('\nRunning Tract-Level Damage Assessment Model for: ', event)
-        o4_TractLevel_DamageAssessmentModel.main(eventdir = event)
+    conn.close()
 
     return
 
@@ -38,4 +79,3 @@ if __name__ == "__main__":
     start_time = time.time()
     main(testingmode=True)
     print("--- {} seconds ---".format(time.time() - start_time))
-
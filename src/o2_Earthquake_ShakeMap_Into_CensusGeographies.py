@@ -229,7 +229,7 @@ def shakemap_into_census_geo(eventdir = config.NapaEventDir):
         #arcpy.MakeFeatureLayer_management(ShakeMapDir+"\Epicenter.shp","Epicenter_lyr")
         arcpy.CopyFeatures_management(os.path.join(eventdir, "Epicenter.shp"),os.path.join(GDB, "epicenter"))
 
-    return
+    return GDB, None
 
 if __name__ == "__main__":
     shakemap_into_census_geo()
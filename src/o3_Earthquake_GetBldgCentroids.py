@@ -1,16 +1,68 @@
 import arcpy
+import collections
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from utils.get_file_paths import get_shakemap_dir
 from utils.get_shakemap_files import get_shakemap_files
+from utils.count_bldgs import count_bldgs_in_partition
 import config
 
+# nominal bytes per building centroid, only used to turn ChunkMemoryLimitMB into a number of buildings per partition.
+# The selection and summary run inside arcpy, so this sets the partition size, it is not a memory ceiling
+BYTES_PER_BLDG = 200
 
-def unique_values(table, field):
-    with arcpy.da.SearchCursor(table, [field]) as cursor:
-        return sorted({row[0] for row in cursor})
 
+def get_state_fips(table):
+    """Return {state name: 2-digit state FIPS} of the states in a county table."""
+    with arcpy.da.SearchCursor(table, ["STATE_NAME", "FIPS"]) as cursor:
+        return {state: fips[:2] for state, fips in cursor}
 
-def shakemap_get_bldgs(bldg_gdb = config.BuildingCentroids, eventdir = config.NapaEventDir):
+
+def iter_oid_ranges(fc, chunk_size):
+    """Yield where clauses that split a feature class into partitions of at most chunk_size ObjectIDs."""
+    oid_field = arcpy.Describe(fc).OIDFieldName
+    with arcpy.da.SearchCursor(fc, ["OID@"], sql_clause=(None, "ORDER BY {}".format(oid_field))) as cursor:
+        row = next(cursor, None)
+    if row is None:
+        return
+    min_oid = row[0]
+    with arcpy.da.SearchCursor(fc, ["OID@"], sql_clause=(None, "ORDER BY {} DESC".format(oid_field))) as cursor:
+        max_oid = next(cursor)[0]
+
+    for start in range(min_oid, max_oid + 1, chunk_size):
+        yield "{0} >= {1} AND {0} < {2}".format(oid_field, start, start + chunk_size)
+
+
+def write_bldg_counts(tracts_fc, counts, output):
+    """Copy the tracts to output with the building count of each tract in a Point_Count field."""
+    arcpy.CopyFeatures_management(tracts_fc, output)
+    arcpy.AddField_management(output, "Point_Count", "LONG")
+    with arcpy.da.UpdateCursor(output, ["FIPS", "Point_Count"]) as cursor:
+        for row in cursor:
+            cursor.updateRow([row[0], counts.get(row[0], 0)])
+
+
+def shakemap_get_bldgs(bldg_gdb = config.BuildingCentroids, eventdir = config.NapaEventDir,
+                       chunked = config.ChunkedMode, memory_limit_mb = config.ChunkMemoryLimitMB,
+                       workers = config.BuildingWorkers):
+    """
+    Count the building centroids that intersect the ShakeMap in each tract.
+
+    Each state (or, in chunked mode, each ObjectID range of a state) is selected and counted in its own
+    worker process, which returns per-tract counts; the counts are then summed.
+
+    Args:
+        bldg_gdb (str): geodatabase of building centroids, one feature class per state
+        eventdir (str): filepath of the event dir
+        chunked (bool): split each state into ObjectID ranges instead of counting whole states
+        memory_limit_mb (float): in chunked mode, sets the partition size: memory_limit_mb / (workers * BYTES_PER_BLDG)
+            buildings per partition
+        workers (int): number of worker processes, None for one per core, 1 to run in this process
+
+    Returns:
+        bldgcount_output (str): tracts feature class with the building count in Point_Count
+        results (dict): None, this stage has no summary to record
+    """
 
     ShakeMapDir = get_shakemap_dir()
     mi, pgv, pga = get_shakemap_files(eventdir)
@@ -20,45 +72,46 @@ def shakemap_get_bldgs(bldg_gdb = config.BuildingCentroids, eventdir = config.Na
     GDB = os.path.join(eventdir, "eqmodel_outputs.gdb")
 
     #get list of intersecting states
-    state_names_list = unique_values(table=os.path.join(GDB, "census_county_max_mmi_pga_pgv"), field="STATE_NAME")
-    bldgs_output = os.path.join(GDB, "ORNL_LB_bldgs")
-
-    #select building centroids that are within intersecting states and intersect them with shakemap
-    remove_list = []
+    state_fips = get_state_fips(table=os.path.join(GDB, "census_county_max_mmi_pga_pgv"))
+    state_names_list = sorted(state_fips)
+    shakemap_fc = os.path.join(GDB, "shakemap_countyclip_mmi")
+    tracts_fc = os.path.join(GDB, "census_tract_max_mmi_pga_pgv")
+    bldgcount_output = os.path.join(GDB, "census_tract_max_mmi_pga_pgv_bldgcount")
+
+    #split building centroids of the intersecting states into partitions
+    #partitions run concurrently, so the budget is shared between the workers
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunk_size = max(1, int(memory_limit_mb * 1024 * 1024 / (workers * BYTES_PER_BLDG)))
+    partitions = []
     for state in state_names_list:
         fc = os.path.join(bldg_gdb, state)
-        if arcpy.Exists(fc):
-            arcpy.management.MakeFeatureLayer(os.path.join(bldg_gdb, state), "{}_lyr".format(state))
-            arcpy.management.SelectLayerByLocation("{}_lyr".format(state), 'INTERSECT', "shakemap_countyclip_mmi", "", "NEW_SELECTION")
+        if not arcpy.Exists(fc):
+            continue
+        if chunked:
+            partitions.extend((fc, where_clause, state_fips[state]) for where_clause in iter_oid_ranges(fc, chunk_size))
         else:
-            remove_list.append(state)
-
-    if len(remove_list) >= 1:
-        for x in remove_list:
-            state_names_list.remove(x)
+            partitions.append((fc, None, state_fips[state]))
 
-    if len(state_names_list) > 1:
-        #merge
-        arcpy.Merge_management(["{}_lyr".format(x) for x in state_names_list], bldgs_output)
+    #count buildings per tract in each partition, then sum the counts
+    counts = collections.Counter()
+    if workers == 1 or len(partitions) <= 1:
+        for fc, where_clause, fips in partitions:
+            counts.update(count_bldgs_in_partition(fc, where_clause, shakemap_fc, tracts_fc, fips))
     else:
-        #copy features
-        arcpy.CopyFeatures_management("{}_lyr".format(state), bldgs_output)
-
-    #Summarize Within Bldg Count to Tracts
-    with arcpy.EnvManager(
-            scratchWorkspace = GDB,
-            workspace = GDB):
-        arcpy.analysis.SummarizeWithin(
-            os.path.join(GDB, "census_tract_max_mmi_pga_pgv"),
-            bldgs_output,
-            os.path.join(GDB, "census_tract_max_mmi_pga_pgv_bldgcount"),
-            "KEEP_ALL", None, "ADD_SHAPE_SUM", '', None, "NO_MIN_MAJ", "NO_PERCENT", None)
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [executor.submit(count_bldgs_in_partition, fc, where_clause, shakemap_fc, tracts_fc, fips)
+                       for fc, where_clause, fips in partitions]
+            for future in as_completed(futures):
+                counts.update(future.result())
+
+    write_bldg_counts(tracts_fc, counts, bldgcount_output)
 
     scratchgdb = os.path.join(eventdir, 'scratch.gdb')
     if arcpy.Exists(scratchgdb):
         arcpy.management.Delete(scratchgdb)
 
-    return bldgs_output
+    return bldgcount_output, None
 
 
 if __name__ == "__main__":
@@ -1,38 +1,67 @@
+import functools
 import os
 import geopandas as gp
 import pandas as pd
 from scipy.stats import norm
 import numpy as np
 import time
+import math
 import config
 
-# Import Spreadsheet with Hazus Building Type Breakdown per Tract
 bldg_percentages_by_tract_csv = r"..\Tables\Building_Percentages_Per_Tract_ALLSTATES.csv"
-bldg_percentages_by_tract_df = pd.read_csv(bldg_percentages_by_tract_csv)
-
-#add leading zeroes to FIPS codes that do not have leading zeroes
-bldg_percentages_by_tract_df["Tract_str"] = bldg_percentages_by_tract_df["Tract"].apply(str)
-for fips in bldg_percentages_by_tract_df["Tract_str"].unique():
-    if len(fips) == 11:
-        None
-    elif len(fips) == 10:
-        # add leading zero to fips string
-        newfips = "0" + fips
-        idx = bldg_percentages_by_tract_df[bldg_percentages_by_tract_df["Tract_str"]==fips]["Tract_str"].index
-        bldg_percentages_by_tract_df.loc[idx, "Tract_str"] = newfips
-
-# Import Damage Function Variables Spreadsheet
 dmgfvars = r"..\Tables\DamageFunctionVariables.csv"
-dmgfvarsDF = pd.read_csv(dmgfvars)
-dmgfvarsDF = dmgfvarsDF.drop('Unnamed: 0', axis=1)
-list_bldgtypes = dmgfvarsDF["BLDG_TYPE"].unique()
 
 
-def main(tracts_layer = "census_tract_max_mmi_pga_pgv_bldgcount", eventdir = config.IdahoEventDir):
+@functools.lru_cache(maxsize=None)
+def load_tables():
+    """
+    Read the Hazus building type breakdown per tract and the damage function variables.
+    They are read on first use rather than on import, so processes that import this module
+    (e.g. the building count workers, which re-import main.py) do not load the nationwide table.
 
-    gdb = os.path.join(eventdir, "eqmodel_outputs.gdb")
+    Returns:
+        (bldg_percentages_by_tract_df, dmgfvarsDF, list_bldgtypes) (tuple)
+    """
+    # Import Spreadsheet with Hazus Building Type Breakdown per Tract
+    bldg_percentages_by_tract_df = pd.read_csv(bldg_percentages_by_tract_csv)
+
+    #add leading zeroes to FIPS codes that do not have leading zeroes
+    bldg_percentages_by_tract_df["Tract_str"] = bldg_percentages_by_tract_df["Tract"].apply(str)
+    for fips in bldg_percentages_by_tract_df["Tract_str"].unique():
+        if len(fips) == 11:
+            None
+        elif len(fips) == 10:
+            # add leading zero to fips string
+            newfips = "0" + fips
+            idx = bldg_percentages_by_tract_df[bldg_percentages_by_tract_df["Tract_str"]==fips]["Tract_str"].index
+            bldg_percentages_by_tract_df.loc[idx, "Tract_str"] = newfips
+
+    # Import Damage Function Variables Spreadsheet
+    dmgfvarsDF = pd.read_csv(dmgfvars)
+    dmgfvarsDF = dmgfvarsDF.drop('Unnamed: 0', axis=1)
+    list_bldgtypes = dmgfvarsDF["BLDG_TYPE"].unique()
+
+    return bldg_percentages_by_tract_df, dmgfvarsDF, list_bldgtypes
+
+
+TOTAL_COLUMNS = ["Point_Count", "Slight", "Moderate", "Extensive", "Complete", "Green", "Yellow", "Red"]
 
-    tracts = gp.read_file(gdb, layer = tracts_layer)
+# a batch of tracts takes several times its own size while it is processed and written
+CHUNK_MEMORY_OVERHEAD = 4
+
+
+def assess_tracts(tracts):
+    """
+    Estimate the number of damaged buildings per damage state for each tract.
+    Tracts are independent of each other, so this can run on the whole layer or on any batch of tracts.
+
+    Args:
+        tracts (GeoDataFrame): tracts with building count (Point_Count) and ground motion fields
+
+    Returns:
+        tracts (GeoDataFrame): tracts with building type, damage state and Green/Yellow/Red fields added
+    """
+    bldg_percentages_by_tract_df, dmgfvarsDF, list_bldgtypes = load_tables()
     tract_FIPS_list = tracts["FIPS"].unique()
 
     newcols = ['W1', 'W2', 'S1L', 'S1M', 'S1H', 'S2L', 'S2M', 'S2H', 'S3',
@@ -41,7 +70,7 @@ def main(tracts_layer = "census_tract_max_mmi_pga_pgv_bldgcount", eventdir = con
                'RM1L', 'RM1M', 'RM2L', 'RM2M', 'RM2H', 'URML', 'URMM', 'MH', 'Slight',
                'Moderate', 'Extensive', 'Complete']
     for col in newcols:
-        tracts[col] = 0
+        tracts[col] = 0.0
 
     for FIPS in tract_FIPS_list:
         subset = tracts[tracts["FIPS"] == FIPS]
@@ -129,9 +158,108 @@ def main(tracts_layer = "census_tract_max_mmi_pga_pgv_bldgcount", eventdir = con
     tracts["Yellow"] = tracts["Extensive"]
     tracts["Red"] = tracts["Complete"]
 
-    tracts.to_file(os.path.join(eventdir, "TractLevel_DamageAssessmentModel_Output.shp"))
+    return tracts
+
+
+def iter_tract_chunks(gdb: str, tracts_layer: str, chunk_size: int):
+    """Yield the tracts layer in batches of at most chunk_size rows, without reading the whole layer."""
+    start = 0
+    while True:
+        chunk = gp.read_file(gdb, layer = tracts_layer, rows = slice(start, start + chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+        start += chunk_size
+
+
+def estimate_chunk_size(gdb: str, tracts_layer: str, memory_limit_mb: float, sample_size: int = 100) -> int:
+    """
+    Estimate how many tracts can be processed at once within memory_limit_mb, from the memory used by a sample of tracts
+    once the building type and damage fields are added.
+    """
+    sample = assess_tracts(gp.read_file(gdb, layer = tracts_layer, rows = slice(0, sample_size)))
+    if len(sample) == 0:
+        return sample_size
+    bytes_per_tract = sample.memory_usage(deep = True).sum() / len(sample)
+    bytes_per_tract += sample.geometry.apply(lambda geom: len(geom.wkb) if geom is not None else 0).mean()
+    # leave room for the copies made while processing and writing each batch
+    return max(1, int(memory_limit_mb * 1024 * 1024 / (CHUNK_MEMORY_OVERHEAD * bytes_per_tract)))
+
+
+def _add_to_partials(partials: list, x: float):
+    """
+    Add x to a running sum kept as Shewchuk partials: non-overlapping floats whose sum is exactly the sum
+    of all the values added so far.
+    """
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+def add_damage_totals(partials: dict, tracts) -> dict:
+    """
+    Add the damage values of a batch of tracts to the running totals, so batches can be merged as they are processed.
+    The totals are kept exact (see _add_to_partials), so they do not depend on how the tracts were split into batches.
+    """
+    for col in TOTAL_COLUMNS:
+        col_partials = partials.setdefault(col, [])
+        for x in tracts[col].to_numpy(dtype = float):
+            _add_to_partials(col_partials, float(x))
+    return partials
+
+
+def sum_damage_totals(partials: dict) -> dict:
+    """Round the running totals to floats. math.fsum of the partials is their correctly rounded sum."""
+    return {col: math.fsum(col_partials) for col, col_partials in partials.items()}
+
+
+def main(tracts_layer = "census_tract_max_mmi_pga_pgv_bldgcount", eventdir = config.IdahoEventDir,
+         chunked = config.ChunkedMode, memory_limit_mb = config.ChunkMemoryLimitMB):
+    """
+    Run the damage model for an event and write TractLevel_DamageAssessmentModel_Output.shp to the event dir.
+
+    Args:
+        tracts_layer (str): tracts layer in the event's eqmodel_outputs.gdb
+        eventdir (str): filepath of the event dir
+        chunked (bool): process the tracts in batches that fit in memory_limit_mb instead of all at once
+        memory_limit_mb (float): memory ceiling of a batch in chunked mode
+
+    Returns:
+        output (str): filepath of the output shapefile
+        totals (dict): total building count and damaged buildings per damage state
+    """
 
-    return
+    gdb = os.path.join(eventdir, "eqmodel_outputs.gdb")
+    output = os.path.join(eventdir, "TractLevel_DamageAssessmentModel_Output.shp")
+    partials = {}
+
+    if not chunked:
+        tracts = assess_tracts(gp.read_file(gdb, layer = tracts_layer))
+        tracts.to_file(output)
+        add_damage_totals(partials, tracts)
+
+    else:
+        chunk_size = estimate_chunk_size(gdb, tracts_layer, memory_limit_mb)
+        print("Processing tracts in batches of {}".format(chunk_size))
+        first = True
+        for chunk in iter_tract_chunks(gdb, tracts_layer, chunk_size):
+            tracts = assess_tracts(chunk)
+            tracts.to_file(output, mode = "w" if first else "a")
+            add_damage_totals(partials, tracts)
+            first = False
+
+    totals = sum_damage_totals(partials)
+    print("Damage totals: {}".format({col: round(total, 2) for col, total in totals.items()}))
+
+    return output, totals
 
 
 
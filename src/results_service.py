@@ -0,0 +1,344 @@
+import collections
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+from utils import event_registry
+import config
+
+OUTPUT_NAME = "TractLevel_DamageAssessmentModel_Output.shp"
+DAMAGE_COLUMNS = ["Slight", "Moderate", "Extensive", "Complete", "Green", "Yellow", "Red"]
+
+# number of features written per chunk of a streamed GeoJSON response
+FEATURES_PER_CHUNK = 500
+
+# event dir, pipeline state and version of the events in the registry
+REGISTRY_QUERY = """
+    SELECT e.event_id, e.event_dir, e.pipeline_state, e.updated, s.completed_at
+    FROM events e
+    LEFT JOIN stages s ON s.event_id = e.event_id AND s.stage = 'damage_assessment'
+"""
+
+
+class LRUCache:
+    """Thread-safe LRU cache of loaded event results, keyed by (event_id, version)."""
+
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            # a new version of an event replaces the older ones
+            for old_key in [k for k in self.entries if k[0] == key[0] and k != key]:
+                del self.entries[old_key]
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, event_id: str):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == event_id]:
+                del self.entries[key]
+
+
+class EventResults:
+    """Damage model outputs of one event version: tracts, counties and totals."""
+
+    def __init__(self, output_path: str):
+        tracts = gpd.read_file(output_path)
+        if tracts.crs is not None and tracts.crs.to_epsg() != 4326:
+            tracts = tracts.to_crs(epsg=4326)
+        tracts["FIPS"] = tracts["FIPS"].astype(str)
+        tracts["COUNTY_FIPS"] = tracts["FIPS"].str[:5]
+        self.tracts = tracts
+
+        self.counties = tracts[["COUNTY_FIPS", "geometry"] + DAMAGE_COLUMNS].dissolve(
+            by="COUNTY_FIPS", aggfunc="sum", as_index=False)
+
+        self.total = {col: float(tracts[col].sum()) for col in DAMAGE_COLUMNS}
+        self.total["Tract_Count"] = int(len(tracts))
+
+
+def filter_frame(gdf, fips_column: str, bbox: list = None, fips: list = None):
+    """
+    Filter tracts or counties.
+
+    Args:
+        gdf (GeoDataFrame): tracts or counties
+        fips_column (str): name of the FIPS column
+        bbox (list): [minx, miny, maxx, maxy] in WGS84, keeps the features that intersect it
+        fips (list): FIPS codes (state, county or tract), keeps the features whose FIPS starts with one of them
+
+    Returns:
+        gdf (GeoDataFrame): filtered copy
+    """
+    if bbox is not None:
+        gdf = gdf.iloc[sorted(gdf.sindex.query(box(*bbox), predicate="intersects"))]
+    if fips:
+        gdf = gdf[gdf[fips_column].str.startswith(tuple(fips))]
+    return gdf
+
+
+def _json_default(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    return str(value)
+
+
+def iter_geojson(gdf):
+    """Yield a GeoJSON FeatureCollection in chunks of bytes, so large responses are never built in memory at once."""
+    yield b'{"type": "FeatureCollection", "features": ['
+    first = True
+    features = []
+    for feature in gdf.iterfeatures(drop_id=True):
+        features.append(json.dumps(feature, default=_json_default))
+        if len(features) == FEATURES_PER_CHUNK:
+            yield ((", " if not first else "") + ", ".join(features)).encode()
+            first = False
+            features = []
+    if features:
+        yield ((", " if not first else "") + ", ".join(features)).encode()
+    yield b"]}"
+
+
+def iter_json_records(df):
+    """Yield the rows of a DataFrame as a JSON array, in chunks of bytes."""
+    yield b"["
+    for start in range(0, len(df), FEATURES_PER_CHUNK):
+        chunk = df.iloc[start:start + FEATURES_PER_CHUNK]
+        # NaN is not valid JSON, write null like the GeoJSON output does
+        records = chunk.astype(object).where(chunk.notna(), None).to_dict(orient="records")
+        yield ((", " if start else "") + ", ".join(
+            json.dumps(r, default=_json_default, allow_nan=False) for r in records)).encode()
+    yield b"]"
+
+
+class ResultsService:
+    """
+    Serves the damage model outputs of each event. Does not depend on HTTP, so queries can be
+    run directly (e.g. against the Napa/Idaho testing directories) without starting a server.
+    """
+
+    def __init__(self, event_dirs: dict = None, registry_path: str = None, cache_size: int = 16):
+        """
+        Args:
+            event_dirs (dict): {event_id: event dir} of events to serve in addition to the event registry,
+                defaults to the Napa and Idaho testing directories from config.py
+            registry_path (str): filepath of the event registry, None to serve event_dirs only
+            cache_size (int): maximum number of event versions kept in memory
+        """
+        if event_dirs is None:
+            event_dirs = {os.path.basename(d): d for d in [config.NapaEventDir, config.IdahoEventDir]}
+        self.event_dirs = event_dirs
+        self.registry_path = registry_path
+        self.cache = LRUCache(cache_size)
+        self.local = threading.local()
+
+    def get_connection(self):
+        """
+        Return this thread's read-only connection to the event registry, or None if there is no registry.
+        The service never creates or modifies the registry.
+        """
+        if self.registry_path is None:
+            return None
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            uri = pathlib.Path(os.path.abspath(self.registry_path)).as_uri() + "?mode=ro"
+            try:
+                conn = sqlite3.connect(uri, uri=True, timeout=60)
+            except sqlite3.OperationalError:
+                # the registry does not exist yet
+                return None
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+        return conn
+
+    def lookup(self, event_id: str):
+        """
+        Return the event dir and the version of the event outputs.
+
+        The version is (ShakeMap "updated" time, time the damage model finished). For events in the registry,
+        only events whose pipeline is complete are served. Events that are only in event_dirs (static testing
+        directories) have no "updated" time (None) and use the modified time of the output files as finish time.
+
+        Returns:
+            (event_dir, version) (tuple): or None if the event has no (complete) outputs
+        """
+        conn = self.get_connection()
+        if conn is not None:
+            row = conn.execute(REGISTRY_QUERY + " WHERE e.event_id = ?", (event_id,)).fetchone()
+            if row is not None:
+                if row["pipeline_state"] != "complete" or row["completed_at"] is None:
+                    return None
+                return row["event_dir"], (row["updated"], row["completed_at"])
+
+        event_dir = self.event_dirs.get(event_id)
+        if event_dir is None:
+            return None
+        try:
+            completed_at = max(os.stat(os.path.join(event_dir, OUTPUT_NAME[:-4] + ext)).st_mtime
+                               for ext in (".shp", ".shx", ".dbf"))
+        except FileNotFoundError:
+            return None
+        return event_dir, (None, completed_at)
+
+    def list_events(self) -> list:
+        events = {}
+        registered = set()
+        conn = self.get_connection()
+        if conn is not None:
+            for row in conn.execute(REGISTRY_QUERY):
+                registered.add(row["event_id"])
+                if row["pipeline_state"] == "complete" and row["completed_at"] is not None:
+                    events[row["event_id"]] = (row["updated"], row["completed_at"])
+
+        for event_id in self.event_dirs:
+            if event_id not in registered:
+                found = self.lookup(event_id)
+                if found is not None:
+                    events[event_id] = found[1]
+
+        return [{"event_id": event_id, "version": events[event_id]} for event_id in sorted(events)]
+
+    def get_results(self, event_id: str):
+        found = self.lookup(event_id)
+        if found is None:
+            self.cache.invalidate(event_id)
+            return None
+
+        event_dir, version = found
+        results = self.cache.get((event_id, version))
+        if results is None:
+            results = EventResults(os.path.join(event_dir, OUTPUT_NAME))
+            self.cache.put((event_id, version), results)
+        return results
+
+    def query(self, path: str, params: dict):
+        """
+        Run a query.
+
+        Routes:
+            /events
+            /events/<event_id>/tracts?bbox=minx,miny,maxx,maxy&fips=06055,06097&format=geojson|json
+            /events/<event_id>/counties?bbox=...&fips=...&format=geojson|json
+            /events/<event_id>/total
+
+        Args:
+            path (str): URL path
+            params (dict): query parameters, as returned by urllib.parse.parse_qs
+
+        Returns:
+            (status, content_type, body) (tuple): HTTP status (int), content type (str) and an iterable of bytes
+        """
+        parts = [p for p in path.split("/") if p]
+
+        if parts == ["events"]:
+            return 200, "application/json", [json.dumps(self.list_events()).encode()]
+
+        if len(parts) != 3 or parts[0] != "events" or parts[2] not in ("tracts", "counties", "total"):
+            return self.error(404, "Not found: {}".format(path))
+
+        event_id, layer = parts[1], parts[2]
+        results = self.get_results(event_id)
+        if results is None:
+            return self.error(404, "No results for event {}".format(event_id))
+
+        if layer == "total":
+            return 200, "application/json", [json.dumps(dict(results.total, event_id=event_id)).encode()]
+
+        bbox = None
+        if "bbox" in params:
+            try:
+                bbox = [float(x) for x in params["bbox"][0].split(",")]
+            except ValueError:
+                bbox = []
+            if len(bbox) != 4:
+                return self.error(400, "bbox must be minx,miny,maxx,maxy")
+        fips = [f for value in params.get("fips", []) for f in value.split(",") if f]
+        output_format = params.get("format", ["geojson"])[0]
+
+        if layer == "tracts":
+            gdf = filter_frame(results.tracts, "FIPS", bbox, fips)
+        else:
+            gdf = filter_frame(results.counties, "COUNTY_FIPS", bbox, fips)
+
+        if output_format == "geojson":
+            return 200, "application/geo+json", iter_geojson(gdf)
+        if output_format == "json":
+            return 200, "application/json", iter_json_records(gdf.drop(columns="geometry"))
+        return self.error(400, "format must be geojson or json")
+
+    @staticmethod
+    def error(status: int, message: str):
+        return status, "application/json", [json.dumps({"error": message}).encode()]
+
+
+def make_handler(service: ResultsService):
+
+    class ResultsHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def write_chunk(self, chunk: bytes):
+            if chunk:
+                self.wfile.write("{:X}\r\n".format(len(chunk)).encode() + chunk + b"\r\n")
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                status, content_type, body = service.query(url.path, parse_qs(url.query))
+                # responses are generated lazily, run the query up to its first chunk before sending the status
+                body = iter(body)
+                first = next(body, b"")
+            except Exception as e:
+                self.log_error("%s failed: %r", self.path, e)
+                status, content_type, body = service.error(500, "Internal error")
+                body = iter(body)
+                first = next(body)
+
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.write_chunk(first)
+            try:
+                for chunk in body:
+                    self.write_chunk(chunk)
+            except Exception as e:
+                # the status was already sent, end the connection without the last chunk so the response is incomplete
+                self.log_error("%s failed while streaming: %r", self.path, e)
+                self.close_connection = True
+                return
+            self.wfile.write(b"0\r\n\r\n")
+
+    return ResultsHandler
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8080, service: ResultsService = None) -> ThreadingHTTPServer:
+    """Create the HTTP server, by default serving the events in the event registry."""
+    if service is None:
+        service = ResultsService(event_dirs={}, registry_path=event_registry.get_registry_path())
+    return ThreadingHTTPServer((host, port), make_handler(service))
+
+
+if __name__ == "__main__":
+    server = make_server()
+    print("Serving damage model results on http://{}:{}/events".format(*server.server_address))
+    server.serve_forever()
@@ -0,0 +1,34 @@
+import arcpy
+
+
+def count_bldgs_in_partition(fc, where_clause, shakemap_fc, tracts_fc, state_fips):
+    """
+    Count the building centroids of one partition of a state that intersect the ShakeMap, per tract.
+    Runs in a worker process, so only the counts (not a feature class) are sent back. It lives in its own module,
+    which only imports arcpy, so unpickling it in a worker does not import the other pipeline stages.
+
+    Args:
+        fc (str): building centroids feature class of a state
+        where_clause (str): selects the partition, None for the whole state
+        shakemap_fc (str): ShakeMap MMI polygons
+        tracts_fc (str): tracts feature class with a FIPS field
+        state_fips (str): 2-digit FIPS of the state, only the tracts of this state are summarized
+
+    Returns:
+        counts (dict): {tract FIPS: building count}, only for tracts that contain buildings
+    """
+    lyr = arcpy.management.MakeFeatureLayer(fc, "bldg_partition_lyr", where_clause)
+    arcpy.management.SelectLayerByLocation(lyr, 'INTERSECT', shakemap_fc, "", "NEW_SELECTION")
+
+    tracts_lyr = arcpy.management.MakeFeatureLayer(tracts_fc, "tracts_partition_lyr", "FIPS LIKE '{}%'".format(state_fips))
+
+    summary = r"memory\bldg_partition_counts"
+    arcpy.analysis.SummarizeWithin(tracts_lyr, lyr, summary, "ONLY_INTERSECTING")
+    with arcpy.da.SearchCursor(summary, ["FIPS", "Point_Count"]) as cursor:
+        counts = {fips: count for fips, count in cursor}
+
+    arcpy.management.Delete(summary)
+    arcpy.management.Delete(lyr)
+    arcpy.management.Delete(tracts_lyr)
+
+    return counts
@@ -0,0 +1,315 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from utils.get_file_paths import get_shakemap_dir
+
+REGISTRY_NAME = "event_registry.sqlite"
+
+# an event claimed by a worker that has not finished after this many seconds can be claimed again
+CLAIM_TIMEOUT = 6 * 60 * 60
+
+# an event being downloaded by a poller that has not finished after this many seconds can be downloaded again
+DOWNLOAD_TIMEOUT = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    event_dir TEXT NOT NULL,
+    status TEXT,
+    updated INTEGER,
+    pipeline_state TEXT NOT NULL DEFAULT 'pending',
+    claimed_by TEXT,
+    claimed_at REAL,
+    modified_at REAL
+);
+CREATE INDEX IF NOT EXISTS events_pipeline_state ON events (pipeline_state, updated);
+CREATE TABLE IF NOT EXISTS stages (
+    event_id TEXT NOT NULL REFERENCES events (event_id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    completed_at REAL,
+    seconds REAL,
+    output_path TEXT,
+    results TEXT,
+    PRIMARY KEY (event_id, stage)
+);
+"""
+
+
+def get_registry_path() -> str:
+    return os.path.join(get_shakemap_dir(), REGISTRY_NAME)
+
+
+def connect(db_path: str = None) -> sqlite3.Connection:
+    """
+    Open the event registry, creating it if needed.
+
+    The database runs in WAL mode so pollers can read while a worker is writing, and
+    writers wait on each other (busy timeout) instead of failing.
+
+    Args:
+        db_path (str): filepath of the SQLite database, defaults to data/shakemaps/event_registry.sqlite
+
+    Returns:
+        conn (sqlite3.Connection): connection in autocommit mode, rows are sqlite3.Row
+    """
+    if db_path is None:
+        db_path = get_registry_path()
+
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.executescript(SCHEMA)
+
+    return conn
+
+
+def record_event(conn: sqlite3.Connection, event_id: str, event_dir: str, status: str, updated) -> bool:
+    """
+    Insert or update an event. A new event, or an event whose status or updated time changed,
+    is (re)queued for processing and its completed stages are cleared.
+
+    Args:
+        conn (sqlite3.Connection): registry connection
+        event_id (str): USGS event id
+        event_dir (str): filepath of the event dir
+        status (str): event status from the USGS feed (e.g. "automatic", "reviewed")
+        updated (int or str): "updated" timestamp (epoch ms) from the USGS feed
+
+    Returns:
+        queued (bool): True if the event needs processing
+    """
+    updated = int(updated)
+    now = time.time()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT status, updated FROM events WHERE event_id = ?", (event_id,)).fetchone()
+        if row is not None and row["status"] == status and row["updated"] >= updated:
+            conn.execute("COMMIT")
+            return False
+
+        conn.execute(
+            """
+            INSERT INTO events (event_id, event_dir, status, updated, pipeline_state, modified_at)
+            VALUES (?, ?, ?, ?, 'pending', ?)
+            ON CONFLICT (event_id) DO UPDATE SET
+                event_dir = excluded.event_dir,
+                status = excluded.status,
+                updated = excluded.updated,
+                pipeline_state = 'pending',
+                claimed_by = NULL,
+                claimed_at = NULL,
+                modified_at = excluded.modified_at
+            """,
+            (event_id, event_dir, status, updated, now),
+        )
+        conn.execute("DELETE FROM stages WHERE event_id = ?", (event_id,))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    return True
+
+
+def get_last_status(conn: sqlite3.Connection, event_id: str):
+    """
+    Return the last recorded status of an event.
+
+    Returns:
+        (status, updated) (tuple): status (str) and updated timestamp (str, epoch ms), or (None, None) if unknown
+    """
+    row = conn.execute("SELECT status, updated FROM events WHERE event_id = ?", (event_id,)).fetchone()
+    if row is None:
+        return None, None
+    return row["status"], str(row["updated"])
+
+
+def get_events_to_process(conn: sqlite3.Connection) -> list:
+    """Return the events that are waiting to be processed (or whose claim timed out), oldest update first."""
+    return conn.execute(
+        """
+        SELECT * FROM events
+        WHERE pipeline_state = 'pending'
+           OR (pipeline_state = 'processing' AND claimed_at < ?)
+        ORDER BY updated
+        """,
+        (time.time() - CLAIM_TIMEOUT,),
+    ).fetchall()
+
+
+def get_active_event_ids(conn: sqlite3.Connection) -> set:
+    """
+    Return the ids of the events that are being downloaded, waiting to be processed or being processed.
+    Downloads that started more than DOWNLOAD_TIMEOUT ago (e.g. the poller died) are not active.
+    """
+    rows = conn.execute(
+        """
+        SELECT event_id FROM events
+        WHERE pipeline_state IN ('pending', 'processing')
+           OR (pipeline_state = 'downloading' AND modified_at >= ?)
+        """,
+        (time.time() - DOWNLOAD_TIMEOUT,),
+    )
+    return {row["event_id"] for row in rows}
+
+
+def delete_event(conn: sqlite3.Connection, event_id: str):
+    """Remove an event and its stages, e.g. once its folder has been evicted."""
+    conn.execute("DELETE FROM events WHERE event_id = ?", (event_id,))
+
+
+def begin_download(conn: sqlite3.Connection, event_id: str) -> bool:
+    """
+    Mark an event as downloading before its folder is archived and replaced, so no worker claims it
+    and no other poller downloads it until record_event queues it again.
+
+    Returns:
+        started (bool): False if a worker is processing the event or another poller is downloading it,
+            in which case its folder must not be touched
+    """
+    now = time.time()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT pipeline_state, claimed_at, modified_at FROM events WHERE event_id = ?",
+                           (event_id,)).fetchone()
+        if row is not None and (
+                (row["pipeline_state"] == "processing" and row["claimed_at"] >= now - CLAIM_TIMEOUT)
+                or (row["pipeline_state"] == "downloading" and row["modified_at"] >= now - DOWNLOAD_TIMEOUT)):
+            conn.execute("COMMIT")
+            return False
+
+        conn.execute(
+            """
+            UPDATE events SET pipeline_state = 'downloading', claimed_by = NULL, claimed_at = NULL, modified_at = ?
+            WHERE event_id = ?
+            """,
+            (now, event_id),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    return True
+
+
+def abort_download(conn: sqlite3.Connection, event_id: str):
+    """
+    Mark an event whose download failed as failed, so retention can evict its folder and the next poll
+    downloads it again while the USGS feed still lists a newer version.
+    """
+    conn.execute(
+        "UPDATE events SET pipeline_state = 'failed', modified_at = ? WHERE event_id = ? AND pipeline_state = 'downloading'",
+        (time.time(), event_id),
+    )
+
+
+def claim_event(conn: sqlite3.Connection, worker: str = None):
+    """
+    Atomically take the next event that needs processing, so parallel workers never process the same event.
+
+    The claim token (event["claimed_by"]) is unique to this claim and must be passed to record_stage and
+    set_pipeline_state; once the event is re-queued or re-claimed, updates with the old token are ignored.
+
+    Args:
+        conn (sqlite3.Connection): registry connection
+        worker (str): name of the worker, defaults to "<hostname>:<pid>"
+
+    Returns:
+        event (sqlite3.Row): the claimed event, or None if nothing needs processing
+    """
+    if worker is None:
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    claim = "{}/{}".format(worker, uuid.uuid4().hex)
+    now = time.time()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            """
+            SELECT event_id FROM events
+            WHERE pipeline_state = 'pending'
+               OR (pipeline_state = 'processing' AND claimed_at < ?)
+            ORDER BY updated
+            LIMIT 1
+            """,
+            (now - CLAIM_TIMEOUT,),
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+
+        conn.execute(
+            """
+            UPDATE events SET pipeline_state = 'processing', claimed_by = ?, claimed_at = ?, modified_at = ?
+            WHERE event_id = ?
+            """,
+            (claim, now, now, row["event_id"]),
+        )
+        event = conn.execute("SELECT * FROM events WHERE event_id = ?", (row["event_id"],)).fetchone()
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    return event
+
+
+def record_stage(conn: sqlite3.Connection, event_id: str, claim: str, stage: str, seconds: float,
+                 output_path: str = None, results: dict = None) -> bool:
+    """
+    Record that a pipeline stage finished for an event.
+
+    Args:
+        conn (sqlite3.Connection): registry connection
+        event_id (str): USGS event id
+        claim (str): claim token returned by claim_event
+        stage (str): name of the stage (e.g. "census_geographies")
+        seconds (float): run time of the stage
+        output_path (str): filepath of the stage output
+        results (dict): summary of the stage output (e.g. damage totals), stored as JSON
+
+    Returns:
+        recorded (bool): False if the claim was lost (the event was re-queued or re-claimed) and nothing was recorded
+    """
+    cursor = conn.execute(
+        """
+        INSERT OR REPLACE INTO stages (event_id, stage, completed_at, seconds, output_path, results)
+        SELECT ?, ?, ?, ?, ?, ?
+        WHERE EXISTS (
+            SELECT 1 FROM events WHERE event_id = ? AND pipeline_state = 'processing' AND claimed_by = ?
+        )
+        """,
+        (event_id, stage, time.time(), seconds, output_path, json.dumps(results) if results is not None else None,
+         event_id, claim),
+    )
+    return cursor.rowcount == 1
+
+
+def get_stages(conn: sqlite3.Connection, event_id: str) -> list:
+    """Return the completed stages of an event, in completion order."""
+    return conn.execute("SELECT * FROM stages WHERE event_id = ? ORDER BY completed_at", (event_id,)).fetchall()
+
+
+def set_pipeline_state(conn: sqlite3.Connection, event_id: str, claim: str, pipeline_state: str) -> bool:
+    """
+    Set the pipeline state of a claimed event ("complete" or "failed").
+
+    Returns:
+        updated (bool): False if the claim was lost (the event was re-queued or re-claimed) and the state was not changed
+    """
+    cursor = conn.execute(
+        """
+        UPDATE events SET pipeline_state = ?, modified_at = ?
+        WHERE event_id = ? AND pipeline_state = 'processing' AND claimed_by = ?
+        """,
+        (pipeline_state, time.time(), event_id, claim),
+    )
+    return cursor.rowcount == 1
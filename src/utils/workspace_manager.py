@@ -0,0 +1,392 @@
+import collections
+import contextlib
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+
+INDEX_NAME = "workspace_index.json"
+OBJECTS_DIR_NAME = "objects"
+
+# a lock on the index held longer than this (e.g. by a poller that died) is considered stale and removed
+LOCK_TIMEOUT = 60 * 60
+
+# legacy status file of event folders downloaded before the event registry existed, kept between versions
+KEEP_FILES = ["event_info.txt"]
+
+
+def get_index_path(shakemap_dir: str) -> str:
+    return os.path.join(shakemap_dir, INDEX_NAME)
+
+
+def get_object_path(shakemap_dir: str, digest: str) -> str:
+    return os.path.join(shakemap_dir, OBJECTS_DIR_NAME, digest[:2], digest + ".gz")
+
+
+@contextlib.contextmanager
+def lock_index(shakemap_dir: str, wait: float = 0.1):
+    """
+    Hold an exclusive lock on the workspace index, so pollers running at the same time do not overwrite
+    each other's changes. Every load_index / save_index that modifies the index must run inside it.
+    """
+    lock_path = get_index_path(shakemap_dir) + ".lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(wait)
+
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def load_index(shakemap_dir: str) -> dict:
+    """
+    Load the workspace index, which lists every event, its versions and the stored objects.
+
+    Args:
+        shakemap_dir (str): root ShakeMap directory (see utils.get_file_paths.get_shakemap_dir)
+
+    Returns:
+        index (dict): {"events": {event_id: {...}}, "objects": {digest: {...}}}
+    """
+    index_path = get_index_path(shakemap_dir)
+    if not os.path.exists(index_path):
+        return {"events": {}, "objects": {}}
+
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+def save_index(shakemap_dir: str, index: dict):
+    """Write the workspace index atomically so a crash never leaves a half-written file."""
+    index_path = get_index_path(shakemap_dir)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, index_path)
+
+
+def list_events(shakemap_dir: str) -> list:
+    """Return the sorted list of event ids known to the workspace, without walking the event folders."""
+    return sorted(load_index(shakemap_dir)["events"].keys())
+
+
+def get_version_key(updated, status: str = None) -> str:
+    """
+    Return the key of an event version: the "updated" timestamp, followed by the status when it is known,
+    so a status change without a new "updated" time is a separate version.
+    """
+    if status is None:
+        return str(updated)
+    return "{}-{}".format(updated, status)
+
+
+def _get_version_updated(version: str) -> int:
+    return int(version.split("-")[0])
+
+
+def list_versions(shakemap_dir: str, event_id: str) -> list:
+    """
+    Return the versions of an event, oldest first.
+
+    Args:
+        shakemap_dir (str): root ShakeMap directory
+        event_id (str): USGS event id
+
+    Returns:
+        versions (list): list of version keys (str, see get_version_key); the last one is the current version
+    """
+    event = load_index(shakemap_dir)["events"].get(event_id)
+    if event is None:
+        return []
+
+    versions = sorted(event["archived"].keys(), key=lambda version: (_get_version_updated(version), version))
+    if event.get("current") is not None and event["current"] not in versions:
+        versions.append(event["current"])
+    return versions
+
+
+def _get_dir_size(path: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+def record_current_version(shakemap_dir: str, event_id: str, event_dir: str, updated: str, status: str = None):
+    """
+    Register the ShakeMap version that is currently extracted in the event folder.
+
+    Args:
+        shakemap_dir (str): root ShakeMap directory
+        event_id (str): USGS event id
+        event_dir (str): filepath of the event dir
+        updated (str): "updated" timestamp (epoch ms) of the event in the USGS feed
+        status (str): status of the event in the USGS feed, None if unknown
+    """
+    with lock_index(shakemap_dir):
+        index = load_index(shakemap_dir)
+        event = index["events"].setdefault(event_id, {"event_dir": event_dir, "archived": {}})
+        event["event_dir"] = event_dir
+        event["current"] = get_version_key(updated, status)
+        event["last_seen"] = time.time()
+        event["size"] = _get_dir_size(event_dir)
+        save_index(shakemap_dir, index)
+
+
+def record_event_size(shakemap_dir: str, event_id: str):
+    """
+    Record the disk size of an event folder, e.g. once the pipeline has written its outputs,
+    so apply_retention reads it from the index instead of walking every event folder.
+    """
+    with lock_index(shakemap_dir):
+        index = load_index(shakemap_dir)
+        event = index["events"].get(event_id)
+        if event is None:
+            return
+        event["size"] = _get_dir_size(event["event_dir"])
+        save_index(shakemap_dir, index)
+
+
+def _hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _store_object(shakemap_dir: str, index: dict, path: str) -> str:
+    """Gzip a file into the object store under its sha256 digest. Identical files are only stored once."""
+    digest = _hash_file(path)
+    object_path = get_object_path(shakemap_dir, digest)
+
+    if not os.path.exists(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = object_path + ".tmp"
+        with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, object_path)
+
+    if digest not in index["objects"]:
+        index["objects"][digest] = {"size": os.path.getsize(object_path)}
+    return digest
+
+
+def _list_event_files(event_dir: str) -> list:
+    """List all files of an event (including file geodatabase contents) relative to the event dir."""
+    rel_paths = []
+    for root, dirs, files in os.walk(event_dir):
+        for file in files:
+            rel_path = os.path.relpath(os.path.join(root, file), event_dir)
+            if rel_path not in KEEP_FILES:
+                rel_paths.append(rel_path)
+    return sorted(rel_paths)
+
+
+def _clear_event_dir(event_dir: str):
+    for entry in os.scandir(event_dir):
+        if entry.name in KEEP_FILES:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+def archive_event_version(shakemap_dir: str, event_id: str, event_dir: str, updated: str, status: str = None) -> dict:
+    """
+    Move the files of the current event version into the compressed, deduplicated object store
+    and empty the event folder so the new ShakeMap version can be extracted.
+
+    Archiving the same version twice does not create a second copy.
+
+    Args:
+        shakemap_dir (str): root ShakeMap directory
+        event_id (str): USGS event id
+        event_dir (str): filepath of the event dir
+        updated (str): "updated" timestamp (epoch ms) of the version being archived
+        status (str): status of the version being archived, None if unknown
+
+    Returns:
+        manifest (dict): {relative file path: object digest} of the archived version
+    """
+    version = get_version_key(updated, status)
+
+    with lock_index(shakemap_dir):
+        index = load_index(shakemap_dir)
+        event = index["events"].setdefault(event_id, {"event_dir": event_dir, "archived": {}, "last_seen": time.time()})
+
+        if version in event["archived"]:
+            manifest = event["archived"][version]["files"]
+        else:
+            manifest = {}
+            for rel_path in _list_event_files(event_dir):
+                manifest[rel_path] = _store_object(shakemap_dir, index, os.path.join(event_dir, rel_path))
+            event["archived"][version] = {"files": manifest, "archived_at": time.time()}
+
+        if event.get("current") == version:
+            event["current"] = None
+        event["size"] = 0
+        save_index(shakemap_dir, index)
+
+    _clear_event_dir(event_dir)
+
+    return manifest
+
+
+def restore_event_version(shakemap_dir: str, event_id: str, version: str, out_dir: str):
+    """
+    Extract an archived event version from the object store.
+
+    Args:
+        shakemap_dir (str): root ShakeMap directory
+        event_id (str): USGS event id
+        version (str): key of the archived version (see list_versions)
+        out_dir (str): directory the files are restored into
+    """
+    index = load_index(shakemap_dir)
+    manifest = index["events"][event_id]["archived"][version]["files"]
+
+    for rel_path, digest in manifest.items():
+        out_path = os.path.join(out_dir, rel_path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with gzip.open(get_object_path(shakemap_dir, digest), "rb") as src, open(out_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def mark_seen(shakemap_dir: str, event_ids: list):
+    """Record that events are still listed in the USGS feed, so they are not evicted as stale."""
+    now = time.time()
+    with lock_index(shakemap_dir):
+        index = load_index(shakemap_dir)
+        for event_id in event_ids:
+            if event_id in index["events"]:
+                index["events"][event_id]["last_seen"] = now
+        save_index(shakemap_dir, index)
+
+
+def apply_retention(shakemap_dir: str, max_age_days: float = None, max_total_bytes: int = None,
+                    protected: set = None) -> tuple:
+    """
+    Bound the disk used by the ShakeMap directory.
+
+    Archived versions older than max_age_days, and whole events (event folder, archived versions and index entry)
+    not seen in the feed for max_age_days, are evicted. Then the oldest archived versions and stale events are
+    evicted until the object store plus the event folders fit in max_total_bytes.
+    Objects that are no longer referenced by any version are deleted.
+
+    Args:
+        shakemap_dir (str): root ShakeMap directory
+        max_age_days (float): maximum age of an archived version or of an event, None to disable
+        max_total_bytes (int): maximum size of the object store and event folders, None to disable
+        protected (set): event ids whose folder must not be evicted (e.g. events still in the feed, or waiting for or
+            being processed), only their archived versions can be evicted
+
+    Returns:
+        (evicted_versions, evicted_events) (tuple): list of (event_id, version) archived versions that were evicted,
+            and list of event ids that were evicted entirely
+    """
+    with lock_index(shakemap_dir):
+        index = load_index(shakemap_dir)
+        protected = protected or set()
+        events = index["events"]
+
+        # number of archived versions referencing each object
+        refcounts = collections.Counter(
+            digest
+            for event in events.values()
+            for version in event["archived"].values()
+            for digest in version["files"].values()
+        )
+        # event folder sizes are recorded in the index when the folder is written (events indexed before sizes
+        # were recorded are measured once)
+        for event in events.values():
+            if "size" not in event:
+                event["size"] = _get_dir_size(event["event_dir"])
+        event_sizes = {event_id: event["size"] for event_id, event in events.items()}
+        total_size = sum(index["objects"][digest]["size"] for digest in refcounts) + sum(event_sizes.values())
+
+        evicted_versions = []
+        evicted_events = []
+
+        def evict_version(event_id, version):
+            nonlocal total_size
+            for digest in events[event_id]["archived"].pop(version)["files"].values():
+                refcounts[digest] -= 1
+                if refcounts[digest] == 0:
+                    total_size -= index["objects"][digest]["size"]
+            evicted_versions.append((event_id, version))
+
+        def evict_event(event_id):
+            nonlocal total_size
+            for version in list(events[event_id]["archived"].keys()):
+                evict_version(event_id, version)
+            if os.path.isdir(events[event_id]["event_dir"]):
+                shutil.rmtree(events[event_id]["event_dir"])
+            total_size -= event_sizes[event_id]
+            del events[event_id]
+            evicted_events.append(event_id)
+
+        # oldest first: archived versions by archive time, events by the last time they were in the feed
+        candidates = sorted(
+            [(archived["archived_at"], event_id, version)
+             for event_id, event in events.items()
+             for version, archived in event["archived"].items()]
+            + [(event.get("last_seen", 0), event_id, None)
+               for event_id, event in events.items() if event_id not in protected]
+        )
+
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400
+            for timestamp, event_id, version in candidates:
+                if timestamp >= cutoff or event_id not in events:
+                    continue
+                if version is None:
+                    evict_event(event_id)
+                elif version in events[event_id]["archived"]:
+                    evict_version(event_id, version)
+
+        if max_total_bytes is not None:
+            for timestamp, event_id, version in candidates:
+                if total_size <= max_total_bytes:
+                    break
+                if event_id not in events:
+                    continue
+                if version is None:
+                    evict_event(event_id)
+                elif version in events[event_id]["archived"]:
+                    evict_version(event_id, version)
+
+        for digest in list(index["objects"].keys()):
+            if refcounts[digest] <= 0:
+                object_path = get_object_path(shakemap_dir, digest)
+                if os.path.exists(object_path):
+                    os.remove(object_path)
+                del index["objects"][digest]
+
+        save_index(shakemap_dir, index)
+
+    for event_id, version in evicted_versions:
+        old_date = datetime.datetime.fromtimestamp(_get_version_updated(version) // 1000).strftime("%Y%m%d")
+        print("Evicted archived ShakeMap files for {} ({}).".format(event_id, old_date))
+    for event_id in evicted_events:
+        print("Evicted event folder for {}.".format(event_id))
+
+    return evicted_versions, evicted_events
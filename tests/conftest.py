@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules import each other as top-level modules (e.g. "from utils import ...", "import config"),
+# the same way they are imported when running python main.py from src
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
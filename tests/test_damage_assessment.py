@@ -0,0 +1,49 @@
+import math
+import random
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+pytest.importorskip("scipy")
+import pandas as pd  # noqa: E402
+from shapely.geometry import box  # noqa: E402
+import o4_TractLevel_DamageAssessmentModel as o4  # noqa: E402
+
+
+@pytest.fixture
+def tracts_gpkg(tmp_path):
+    """Write 500 tracts whose damage values span many orders of magnitude, so a naive sum depends on the order."""
+    rng = random.Random(0)
+    n = 500
+    columns = {col: [rng.choice([1e12, 1.0, 1e-6]) * rng.random() for _ in range(n)] for col in o4.TOTAL_COLUMNS}
+    tracts = gpd.GeoDataFrame(
+        dict(columns, FIPS=["06055{:06d}".format(i) for i in range(n)]),
+        geometry=[box(i, 0, i + 1, 1) for i in range(n)],
+        crs="EPSG:4326",
+    )
+    path = str(tmp_path / "tracts.gpkg")
+    tracts.to_file(path, layer="tracts")
+    return path, columns
+
+
+def test_iter_tract_chunks_reads_every_tract_once(tracts_gpkg):
+    path, columns = tracts_gpkg
+
+    chunks = list(o4.iter_tract_chunks(path, "tracts", 64))
+
+    assert [len(chunk) for chunk in chunks] == [64] * 7 + [52]
+    assert list(pd.concat(chunks)["FIPS"]) == ["06055{:06d}".format(i) for i in range(500)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 1000])
+def test_chunked_totals_equal_in_memory_totals(tracts_gpkg, chunk_size):
+    path, columns = tracts_gpkg
+
+    in_memory = o4.sum_damage_totals(o4.add_damage_totals({}, gpd.read_file(path, layer="tracts")))
+
+    partials = {}
+    for chunk in o4.iter_tract_chunks(path, "tracts", chunk_size):
+        o4.add_damage_totals(partials, chunk)
+    chunked = o4.sum_damage_totals(partials)
+
+    assert chunked == in_memory
+    assert chunked == {col: math.fsum(values) for col, values in columns.items()}
@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+import pytest
+from utils import event_registry
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "event_registry.sqlite")
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = event_registry.connect(db_path)
+    yield conn
+    conn.close()
+
+
+def test_record_event_queues_new_and_updated_events(conn):
+    assert event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+    assert not event_registry.record_event(conn, "us1", "/data/us1", "automatic", "100")
+    assert event_registry.record_event(conn, "us2", "/data/us2", "reviewed", 50)
+
+    assert [row["event_id"] for row in event_registry.get_events_to_process(conn)] == ["us2", "us1"]
+    assert event_registry.get_last_status(conn, "us1") == ("automatic", "100")
+    assert event_registry.get_last_status(conn, "unknown") == (None, None)
+
+
+def test_pending_events_query_uses_index(conn):
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT event_id FROM events WHERE pipeline_state = 'pending' ORDER BY updated"
+    ).fetchall()
+    assert "events_pipeline_state" in plan[0][3]
+
+
+def test_claim_and_complete(conn):
+    event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+
+    claimed = event_registry.claim_event(conn, "w1")
+    assert claimed["event_id"] == "us1"
+    assert event_registry.claim_event(conn, "w2") is None
+
+    claim = claimed["claimed_by"]
+    assert event_registry.record_stage(conn, "us1", claim, "census_geographies", 1.5, "/data/us1/eqmodel_outputs.gdb")
+    assert event_registry.set_pipeline_state(conn, "us1", claim, "complete")
+
+    stages = event_registry.get_stages(conn, "us1")
+    assert [(row["stage"], row["seconds"]) for row in stages] == [("census_geographies", 1.5)]
+    assert event_registry.get_events_to_process(conn) == []
+
+
+def test_requeued_event_is_not_overwritten_by_stale_claim(conn):
+    event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+    claim = event_registry.claim_event(conn, "w1")["claimed_by"]
+
+    # a new ShakeMap version arrives while w1 is processing
+    event_registry.record_event(conn, "us1", "/data/us1", "reviewed", 200)
+
+    assert not event_registry.record_stage(conn, "us1", claim, "census_geographies", 1.0)
+    assert not event_registry.set_pipeline_state(conn, "us1", claim, "complete")
+    assert event_registry.get_stages(conn, "us1") == []
+    assert [row["event_id"] for row in event_registry.get_events_to_process(conn)] == ["us1"]
+
+
+def test_begin_download_skips_events_being_processed(conn):
+    event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+    event_registry.record_event(conn, "us2", "/data/us2", "automatic", 100)
+    event_registry.claim_event(conn, "w1")
+
+    assert not event_registry.begin_download(conn, "us1")
+    assert event_registry.begin_download(conn, "us2")
+    assert event_registry.begin_download(conn, "new")
+    # another poller cannot download the same event at the same time
+    assert not event_registry.begin_download(conn, "us2")
+
+    # an event being downloaded is not claimed until it is queued again
+    assert event_registry.claim_event(conn, "w2") is None
+    assert event_registry.get_active_event_ids(conn) == {"us1", "us2"}
+    event_registry.record_event(conn, "us2", "/data/us2", "reviewed", 200)
+    assert event_registry.claim_event(conn, "w2")["event_id"] == "us2"
+
+
+def test_parallel_workers_claim_each_event_once(db_path, conn):
+    for i in range(20):
+        event_registry.record_event(conn, "us{}".format(i), "/data/us{}".format(i), "automatic", i)
+
+    claimed = []
+
+    def worker():
+        worker_conn = event_registry.connect(db_path)
+        event = event_registry.claim_event(worker_conn)
+        while event is not None:
+            claimed.append(event["event_id"])
+            event_registry.set_pipeline_state(worker_conn, event["event_id"], event["claimed_by"], "complete")
+            event = event_registry.claim_event(worker_conn)
+        worker_conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted("us{}".format(i) for i in range(20))
+
+
+def test_stage_results_are_recorded(conn):
+    event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+    claim = event_registry.claim_event(conn, "w1")["claimed_by"]
+    totals = {"Point_Count": 120.0, "Complete": 1.5}
+
+    assert event_registry.record_stage(conn, "us1", claim, "damage_assessment", 2.0, "/data/us1/output.shp", totals)
+
+    assert json.loads(event_registry.get_stages(conn, "us1")[0]["results"]) == totals
+
+
+def test_begin_download_takes_over_stale_downloads(conn):
+    event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+    assert event_registry.begin_download(conn, "us1")
+
+    # the poller that started the download died
+    conn.execute("UPDATE events SET modified_at = ?", (time.time() - event_registry.DOWNLOAD_TIMEOUT - 1,))
+    assert event_registry.begin_download(conn, "us1")
+
+
+def test_failed_and_stale_downloads_are_not_active(conn):
+    event_registry.record_event(conn, "us1", "/data/us1", "automatic", 100)
+    event_registry.record_event(conn, "us2", "/data/us2", "automatic", 100)
+    event_registry.begin_download(conn, "us1")
+    event_registry.begin_download(conn, "us2")
+
+    event_registry.abort_download(conn, "us1")
+    conn.execute("UPDATE events SET modified_at = ? WHERE event_id = 'us2'",
+                 (time.time() - event_registry.DOWNLOAD_TIMEOUT - 1,))
+
+    assert event_registry.get_active_event_ids(conn) == set()
+    # the failed download is retried by the next poll
+    assert event_registry.begin_download(conn, "us1")
@@ -0,0 +1,178 @@
+import http.client
+import json
+import os
+import threading
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+from shapely.geometry import box  # noqa: E402
+import config  # noqa: E402
+import results_service  # noqa: E402
+from utils import event_registry  # noqa: E402
+
+NAPA_ID = os.path.basename(config.NapaEventDir)
+
+
+def write_output(event_dir, red=1.0, slight=None):
+    """Write a small damage model output: two tracts in Napa county (06055) and one in Sonoma county (06097)."""
+    os.makedirs(event_dir, exist_ok=True)
+    tracts = gpd.GeoDataFrame(
+        {
+            "FIPS": ["06055000100", "06055000200", "06097000100"],
+            "Slight": slight or [1.0, 2.0, 3.0],
+            "Moderate": [1.0, 1.0, 1.0],
+            "Extensive": [0.5, 0.5, 0.5],
+            "Complete": [0.25, 0.25, 0.25],
+            "Green": [2.0, 3.0, 4.0],
+            "Yellow": [0.5, 0.5, 0.5],
+            "Red": [red, red, red],
+        },
+        geometry=[box(-122.5, 38.2, -122.4, 38.3), box(-122.4, 38.2, -122.3, 38.3), box(-122.9, 38.4, -122.8, 38.5)],
+        crs="EPSG:4326",
+    )
+    tracts.to_file(os.path.join(event_dir, results_service.OUTPUT_NAME))
+
+
+def run_query(service, path, **params):
+    status, content_type, body = service.query(path, {k: [v] for k, v in params.items()})
+    return status, json.loads(b"".join(body))
+
+
+@pytest.fixture
+def napa_dir(tmp_path):
+    event_dir = str(tmp_path / NAPA_ID)
+    write_output(event_dir)
+    return event_dir
+
+
+@pytest.fixture
+def service(napa_dir):
+    return results_service.ResultsService(event_dirs={NAPA_ID: napa_dir})
+
+
+def test_total(service):
+    status, total = run_query(service, "/events/{}/total".format(NAPA_ID))
+    assert status == 200
+    assert total["Slight"] == 6.0
+    assert total["Red"] == 3.0
+    assert total["Tract_Count"] == 3
+
+
+def test_bbox_filter(service):
+    status, tracts = run_query(service, "/events/{}/tracts".format(NAPA_ID), bbox="-122.45,38.25,-122.44,38.26")
+    assert status == 200
+    assert [f["properties"]["FIPS"] for f in tracts["features"]] == ["06055000100"]
+
+
+def test_fips_filter(service):
+    status, tracts = run_query(service, "/events/{}/tracts".format(NAPA_ID), fips="06055", format="json")
+    assert status == 200
+    assert [t["FIPS"] for t in tracts] == ["06055000100", "06055000200"]
+
+    status, counties = run_query(service, "/events/{}/counties".format(NAPA_ID), fips="06097", format="json")
+    assert status == 200
+    assert [(c["COUNTY_FIPS"], c["Slight"]) for c in counties] == [("06097", 3.0)]
+
+
+def test_error_paths(service):
+    assert run_query(service, "/events/{}/tracts".format(NAPA_ID), bbox="1,2,3")[0] == 400
+    assert run_query(service, "/events/{}/tracts".format(NAPA_ID), bbox="a,b,c,d")[0] == 400
+    assert run_query(service, "/events/{}/tracts".format(NAPA_ID), format="csv")[0] == 400
+    assert run_query(service, "/events/unknown/total")[0] == 404
+    assert run_query(service, "/unknown")[0] == 404
+
+
+def test_json_output_writes_nan_as_null(tmp_path):
+    event_dir = str(tmp_path / NAPA_ID)
+    write_output(event_dir, slight=[1.0, float("nan"), 3.0])
+    service = results_service.ResultsService(event_dirs={NAPA_ID: event_dir})
+
+    status, tracts = run_query(service, "/events/{}/tracts".format(NAPA_ID), format="json")
+    assert status == 200
+    assert tracts[1]["Slight"] is None
+
+
+def test_cache_is_replaced_when_output_version_changes(service, napa_dir):
+    assert run_query(service, "/events/{}/total".format(NAPA_ID))[1]["Red"] == 3.0
+    updated, completed_at = service.lookup(NAPA_ID)[1]
+    assert updated is None
+
+    write_output(napa_dir, red=10.0)
+    os.utime(os.path.join(napa_dir, results_service.OUTPUT_NAME), (completed_at + 1, completed_at + 1))
+
+    assert run_query(service, "/events/{}/total".format(NAPA_ID))[1]["Red"] == 30.0
+    assert list(service.cache.entries) == [(NAPA_ID, service.lookup(NAPA_ID)[1])]
+
+
+def test_registry_events_are_served_once_complete(tmp_path, napa_dir):
+    db_path = str(tmp_path / "event_registry.sqlite")
+    conn = event_registry.connect(db_path)
+    event_registry.record_event(conn, NAPA_ID, napa_dir, "reviewed", 100)
+    service = results_service.ResultsService(event_dirs={}, registry_path=db_path)
+
+    claim = event_registry.claim_event(conn)["claimed_by"]
+    assert run_query(service, "/events/{}/total".format(NAPA_ID))[0] == 404
+
+    event_registry.record_stage(conn, NAPA_ID, claim, "damage_assessment", 1.0)
+    event_registry.set_pipeline_state(conn, NAPA_ID, claim, "complete")
+    assert run_query(service, "/events/{}/total".format(NAPA_ID))[0] == 200
+    assert [event["event_id"] for event in service.list_events()] == [NAPA_ID]
+
+    # a new ShakeMap version is not served until the model finishes for it
+    event_registry.record_event(conn, NAPA_ID, napa_dir, "reviewed", 200)
+    assert run_query(service, "/events/{}/total".format(NAPA_ID))[0] == 404
+    assert service.list_events() == []
+    conn.close()
+
+
+def test_missing_registry_is_not_created(tmp_path, napa_dir):
+    db_path = str(tmp_path / "missing.sqlite")
+    service = results_service.ResultsService(event_dirs={NAPA_ID: napa_dir}, registry_path=db_path)
+
+    assert [event["event_id"] for event in service.list_events()] == [NAPA_ID]
+    assert not os.path.exists(db_path)
+
+
+@pytest.fixture
+def server(service):
+    server = results_service.make_server(port=0, service=service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_streams_chunked_responses(server, service, monkeypatch):
+    # one feature per chunk, so the response is split into several chunks
+    monkeypatch.setattr(results_service, "FEATURES_PER_CHUNK", 1)
+    conn = http.client.HTTPConnection(*server.server_address)
+
+    # both requests run on the same connection, so each chunked response must be terminated correctly
+    for path, status in [("/events/{}/tracts".format(NAPA_ID), 200), ("/events/unknown/total", 404),
+                         ("/events/{}/tracts?format=csv".format(NAPA_ID), 400)]:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        assert response.status == status
+        assert response.getheader("Transfer-Encoding") == "chunked"
+        body = json.loads(response.read())
+        if status == 200:
+            assert body == json.loads(b"".join(service.query(path, {})[2]))
+            assert len(body["features"]) == 3
+        else:
+            assert "error" in body
+    conn.close()
+
+
+def test_server_returns_500_when_a_query_fails(server, service, monkeypatch):
+    def fail(event_id):
+        raise OSError("corrupt output")
+
+    monkeypatch.setattr(service, "get_results", fail)
+    conn = http.client.HTTPConnection(*server.server_address)
+    conn.request("GET", "/events/{}/total".format(NAPA_ID))
+    response = conn.getresponse()
+
+    assert response.status == 500
+    assert json.loads(response.read()) == {"error": "Internal error"}
+    conn.close()
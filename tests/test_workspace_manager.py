@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from utils import workspace_manager
+
+
+def make_event(shakemap_dir, event_id, files):
+    event_dir = os.path.join(str(shakemap_dir), event_id)
+    for rel_path, content in files.items():
+        path = os.path.join(event_dir, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+    return event_dir
+
+
+def test_archive_deduplicates_and_restores(tmp_path):
+    shakemap_dir = str(tmp_path)
+    event_dir = make_event(tmp_path, "us1", {"mi.shp": "a" * 1000, "pga.shp": "b" * 1000,
+                                             "eqmodel_outputs.gdb/a00000001.gdbtable": "a" * 1000})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1600000000000")
+
+    manifest = workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000")
+
+    assert sorted(manifest) == [os.path.join("eqmodel_outputs.gdb", "a00000001.gdbtable"), "mi.shp", "pga.shp"]
+    assert os.listdir(event_dir) == []
+    # identical files are stored once
+    assert len(workspace_manager.load_index(shakemap_dir)["objects"]) == 2
+
+    # archiving the same version again does not add a copy
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    assert workspace_manager.list_versions(shakemap_dir, "us1") == ["1600000000000"]
+
+    workspace_manager.restore_event_version(shakemap_dir, "us1", "1600000000000", str(tmp_path / "restored"))
+    with open(tmp_path / "restored" / "pga.shp") as f:
+        assert f.read() == "b" * 1000
+
+
+def test_list_events_and_versions(tmp_path):
+    shakemap_dir = str(tmp_path)
+    event_dir = make_event(tmp_path, "us1", {"mi.shp": "a"})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    make_event(tmp_path, "us1", {"mi.shp": "b"})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1700000000000")
+
+    assert workspace_manager.list_events(shakemap_dir) == ["us1"]
+    assert workspace_manager.list_versions(shakemap_dir, "us1") == ["1600000000000", "1700000000000"]
+
+
+def test_retention_evicts_old_versions_and_stale_events(tmp_path):
+    shakemap_dir = str(tmp_path)
+    old_dir = make_event(tmp_path, "old", {"mi.shp": "a" * 1000})
+    workspace_manager.record_current_version(shakemap_dir, "old", old_dir, "1600000000000")
+    new_dir = make_event(tmp_path, "new", {"mi.shp": "b" * 1000})
+    workspace_manager.record_current_version(shakemap_dir, "new", new_dir, "1600000000000")
+    workspace_manager.archive_event_version(shakemap_dir, "new", new_dir, "1600000000000")
+    make_event(tmp_path, "new", {"mi.shp": "c" * 1000})
+
+    index = workspace_manager.load_index(shakemap_dir)
+    index["events"]["old"]["last_seen"] = time.time() - 10 * 86400
+    index["events"]["new"]["archived"]["1600000000000"]["archived_at"] = time.time() - 10 * 86400
+    workspace_manager.save_index(shakemap_dir, index)
+
+    evicted_versions, evicted_events = workspace_manager.apply_retention(shakemap_dir, max_age_days=5)
+
+    assert evicted_events == ["old"]
+    assert evicted_versions == [("new", "1600000000000")]
+    assert not os.path.exists(old_dir)
+    assert os.path.exists(os.path.join(new_dir, "mi.shp"))
+    index = workspace_manager.load_index(shakemap_dir)
+    assert list(index["events"]) == ["new"]
+    assert index["objects"] == {}
+
+
+def test_retention_counts_event_folders_toward_size_budget(tmp_path):
+    shakemap_dir = str(tmp_path)
+    for i, event_id in enumerate(["us1", "us2", "us3"]):
+        event_dir = make_event(tmp_path, event_id, {"eqmodel_outputs.gdb/a.gdbtable": str(i) * 1000})
+        workspace_manager.record_current_version(shakemap_dir, event_id, event_dir, "1600000000000")
+        index = workspace_manager.load_index(shakemap_dir)
+        index["events"][event_id]["last_seen"] = 1000 + i
+        workspace_manager.save_index(shakemap_dir, index)
+
+    evicted_versions, evicted_events = workspace_manager.apply_retention(shakemap_dir, max_total_bytes=1500,
+                                                                         protected={"us1"})
+
+    # us1 is protected, so the other events are evicted oldest first until the folders fit in the budget
+    assert evicted_events == ["us2", "us3"]
+    assert workspace_manager.list_events(shakemap_dir) == ["us1"]
+
+
+def test_retention_keeps_objects_shared_with_remaining_versions(tmp_path):
+    shakemap_dir = str(tmp_path)
+    event_dir = make_event(tmp_path, "us1", {"mi.shp": "a" * 1000, "pga.shp": "b" * 1000})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    make_event(tmp_path, "us1", {"mi.shp": "a" * 1000})
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1700000000000")
+    index = workspace_manager.load_index(shakemap_dir)
+    index["events"]["us1"]["archived"]["1600000000000"]["archived_at"] = 0
+    workspace_manager.save_index(shakemap_dir, index)
+    objects = workspace_manager.load_index(shakemap_dir)["objects"]
+
+    evicted_versions, evicted_events = workspace_manager.apply_retention(
+        shakemap_dir, max_total_bytes=min(obj["size"] for obj in objects.values()) + 1, protected={"us1"})
+
+    assert evicted_versions == [("us1", "1600000000000")]
+    assert evicted_events == []
+    workspace_manager.restore_event_version(shakemap_dir, "us1", "1700000000000", str(tmp_path / "restored"))
+    assert os.listdir(tmp_path / "restored") == ["mi.shp"]
+
+
+def test_concurrent_updates_are_not_lost(tmp_path):
+    shakemap_dir = str(tmp_path)
+    event_ids = ["us{}".format(i) for i in range(20)]
+
+    def poll(event_id):
+        event_dir = make_event(tmp_path, event_id, {"mi.shp": event_id})
+        workspace_manager.record_current_version(shakemap_dir, event_id, event_dir, "1600000000000")
+        workspace_manager.archive_event_version(shakemap_dir, event_id, event_dir, "1600000000000")
+
+    threads = [threading.Thread(target=poll, args=(event_id,)) for event_id in event_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert workspace_manager.list_events(shakemap_dir) == sorted(event_ids)
+    assert len(workspace_manager.load_index(shakemap_dir)["objects"]) == len(event_ids)
+    assert not os.path.exists(workspace_manager.get_index_path(shakemap_dir) + ".lock")
+
+
+def test_event_sizes_are_recorded_in_the_index(tmp_path):
+    shakemap_dir = str(tmp_path)
+    event_dir = make_event(tmp_path, "us1", {"mi.shp": "a" * 1000})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    assert workspace_manager.load_index(shakemap_dir)["events"]["us1"]["size"] == 1000
+
+    # the pipeline writes its outputs
+    make_event(tmp_path, "us1", {"eqmodel_outputs.gdb/a.gdbtable": "b" * 2000})
+    workspace_manager.record_event_size(shakemap_dir, "us1")
+    assert workspace_manager.load_index(shakemap_dir)["events"]["us1"]["size"] == 3000
+
+    # retention reads the recorded size instead of walking the folder
+    make_event(tmp_path, "us1", {"scratch.gdb/a.gdbtable": "c" * 5000})
+    evicted_versions, evicted_events = workspace_manager.apply_retention(shakemap_dir, max_total_bytes=4000)
+    assert evicted_events == []
+
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000")
+    assert workspace_manager.load_index(shakemap_dir)["events"]["us1"]["size"] == 0
+
+
+def test_status_change_is_archived_as_a_separate_version(tmp_path):
+    shakemap_dir = str(tmp_path)
+    event_dir = make_event(tmp_path, "us1", {"mi.shp": "automatic"})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1600000000000", "automatic")
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000", "automatic")
+
+    # the status changes without a new "updated" time
+    make_event(tmp_path, "us1", {"mi.shp": "reviewed"})
+    workspace_manager.record_current_version(shakemap_dir, "us1", event_dir, "1600000000000", "reviewed")
+    workspace_manager.archive_event_version(shakemap_dir, "us1", event_dir, "1600000000000", "reviewed")
+
+    versions = workspace_manager.list_versions(shakemap_dir, "us1")
+    assert versions == ["1600000000000-automatic", "1600000000000-reviewed"]
+    for version in versions:
+        workspace_manager.restore_event_version(shakemap_dir, "us1", version, str(tmp_path / version))
+        with open(tmp_path / version / "mi.shp") as f:
+            assert f.read() == version.split("-")[1]